@@ -0,0 +1,42 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""A lightkube Client that counts the Kubernetes API calls made through it."""
+
+from collections import Counter
+
+from lightkube import Client
+
+
+class ApiCallCountingClient(Client):
+    """A lightkube Client counting the calls to each of its API methods in `api_calls`."""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the client, with no API calls counted."""
+        super().__init__(*args, **kwargs)
+        self.api_calls = Counter()
+
+    def get(self, *args, **kwargs):
+        """Get an object, counting the call."""
+        self.api_calls["get"] += 1
+        return super().get(*args, **kwargs)
+
+    def list(self, *args, **kwargs):  # noqa: A003
+        """List objects, counting the call."""
+        self.api_calls["list"] += 1
+        return super().list(*args, **kwargs)
+
+    def apply(self, *args, **kwargs):
+        """Server-side apply an object, counting the call."""
+        self.api_calls["apply"] += 1
+        return super().apply(*args, **kwargs)
+
+    def patch(self, *args, **kwargs):
+        """Patch an object, counting the call."""
+        self.api_calls["patch"] += 1
+        return super().patch(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        """Delete an object, counting the call."""
+        self.api_calls["delete"] += 1
+        return super().delete(*args, **kwargs)
@@ -4,8 +4,18 @@ import tempfile
 from pathlib import Path
 from subprocess import check_call
 
+from opentelemetry import trace
+
 SSL_CONFIG_FILE = "src/templates/ssl.conf.j2"
 
+tracer = trace.get_tracer(__name__)
+
+
+def _traced_check_call(args: list):
+    """Run check_call inside a tracing span named after the command and its subcommand."""
+    with tracer.start_as_current_span(" ".join(args[:2])):
+        check_call(args)
+
 
 def gen_certs(model: str, service_name: str):
     """Generate certificates."""
@@ -20,9 +30,9 @@ def gen_certs(model: str, service_name: str):
         Path(tmp_dir + "/cert-gen-ssl.conf").write_text(ssl_conf)
 
         # execute OpenSSL commands
-        check_call(["openssl", "genrsa", "-out", tmp_dir + "/cert-gen-ca.key", "2048"])
-        check_call(["openssl", "genrsa", "-out", tmp_dir + "/cert-gen-server.key", "2048"])
-        check_call(
+        _traced_check_call(["openssl", "genrsa", "-out", tmp_dir + "/cert-gen-ca.key", "2048"])
+        _traced_check_call(["openssl", "genrsa", "-out", tmp_dir + "/cert-gen-server.key", "2048"])
+        _traced_check_call(
             [
                 "openssl",
                 "req",
@@ -40,7 +50,7 @@ def gen_certs(model: str, service_name: str):
                 tmp_dir + "/cert-gen-ca.crt",
             ]
         )
-        check_call(
+        _traced_check_call(
             [
                 "openssl",
                 "req",
@@ -54,7 +64,7 @@ def gen_certs(model: str, service_name: str):
                 tmp_dir + "/cert-gen-ssl.conf",
             ]
         )
-        check_call(
+        _traced_check_call(
             [
                 "openssl",
                 "x509",
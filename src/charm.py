@@ -6,28 +6,48 @@
 """A Juju Charm for Namespace Node Affinity."""
 
 import logging
+import os
+import re
+import time
 from base64 import b64encode
+from collections import Counter
+from contextlib import contextmanager
 
+import ops
 import yaml
 from charmed_kubeflow_chisme.exceptions import ErrorWithStatus
 from charmed_kubeflow_chisme.kubernetes import (
     KubernetesResourceHandler,
     create_charm_default_labels,
 )
-from lightkube import ApiError
+from lightkube import ApiError, codecs
 from lightkube.generic_resource import load_in_cluster_generic_resources
 from lightkube.resources.admissionregistration_v1 import MutatingWebhookConfiguration
 from lightkube.resources.apps_v1 import Deployment
 from lightkube.resources.core_v1 import ConfigMap, Secret, Service, ServiceAccount
 from lightkube.resources.rbac_authorization_v1 import Role, RoleBinding
+from lightkube.resources.scheduling_v1 import PriorityClass
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import ConsoleSpanExporter, SimpleSpanProcessor
 from ops import main
 from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.model import ActiveStatus, BlockedStatus, ErrorStatus, MaintenanceStatus, WaitingStatus
 
+from api_call_counter import ApiCallCountingClient
 from certs import gen_certs
 
 K8S_RESOURCE_FILES = ["src/templates/webhook_resources.yaml"]
+IMAGE_PULL_POLICIES = ["Always", "IfNotPresent", "Never"]
+# Kubernetes object names must be DNS-1123 subdomains
+DNS_1123_SUBDOMAIN = re.compile(
+    r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?(\.[a-z0-9]([-a-z0-9]*[a-z0-9])?)*$"
+)
+# Kubernetes rejects user-defined PriorityClasses with a value above this
+MAX_PRIORITY_CLASS_VALUE = 1000000000
+
+tracer = trace.get_tracer(__name__)
 
 
 class NamespaceNodeAffinityOperator(CharmBase):
@@ -45,6 +65,15 @@ class NamespaceNodeAffinityOperator(CharmBase):
         self._lightkube_field_manager = "lightkube"
         self._name = self.model.app.name
 
+        # durations (in seconds) of the phases run during this hook, logged on commit
+        self._phase_durations = {}
+        self.tracing = ops.tracing.Tracing(
+            self,
+            tracing_relation_name="charm-tracing",
+            ca_relation_name="receive-ca-cert",
+        )
+        self._add_tracing_file_sink()
+
         self._gen_certs_if_missing()
 
         self._k8s_resource_handler = None
@@ -56,6 +85,7 @@ class NamespaceNodeAffinityOperator(CharmBase):
         self.framework.observe(self.on.remove, self.main)
         self.framework.observe(self.on.upgrade_charm, self.main)
         self.framework.observe(self.on.remove, self._on_remove)
+        self.framework.observe(self.framework.on.commit, self._log_phase_summary)
 
     def main(self, _):
         """Entrypoint for most charm events."""
@@ -81,7 +111,24 @@ class NamespaceNodeAffinityOperator(CharmBase):
         self.logger.info("_deploy_k8s_resources")
         try:
             self.unit.status = MaintenanceStatus("Creating K8S resources")
-            self.k8s_resource_handler.apply()
+            # read the handler once, so generic resource discovery runs once and outside of the
+            # render and apply phases
+            k8s_resource_handler = self.k8s_resource_handler
+            with self._trace_phase("render") as span:
+                # the context is only set here, so that removing the charm never depends on the
+                # config being valid
+                k8s_resource_handler.context = self._context
+                resources = k8s_resource_handler.render_manifests()
+                span.set_attribute("k8s.objects", len(resources))
+                if span.is_recording():
+                    span.set_attribute(
+                        "k8s.payload_bytes", len(codecs.dump_all_yaml(resources).encode())
+                    )
+            # apply reuses the manifests cached by render_manifests above
+            with self._trace_phase("apply") as span:
+                with self._record_api_calls(k8s_resource_handler, span):
+                    self._reconcile_priority_classes(k8s_resource_handler, resources)
+                    k8s_resource_handler.apply()
         except ApiError:
             self.logger.error("K8S resource creation failed with ApiError:")
             self.logger.error(str(ApiError))
@@ -90,6 +137,43 @@ class NamespaceNodeAffinityOperator(CharmBase):
 
         self.model.unit.status = MaintenanceStatus("K8S resources created")
 
+    def _reconcile_priority_classes(self, k8s_resource_handler, resources):
+        """Prepare the PriorityClasses in the cluster for applying the rendered resources.
+
+        PriorityClasses are cluster-scoped and their value is immutable, so before applying this:
+        * deletes the PriorityClasses created by this charm that are no longer rendered
+        * deletes those whose value changed, so that apply recreates them with the new value
+        * raises ErrorWithStatus if a PriorityClass to be created already exists but was not
+          created by this charm, rather than taking it over
+        """
+        client = k8s_resource_handler.lightkube_client
+        desired = {r.metadata.name: r for r in resources if isinstance(r, PriorityClass)}
+        deployed = {
+            pc.metadata.name: pc
+            for pc in client.list(PriorityClass, labels=k8s_resource_handler.labels)
+        }
+
+        for name, priority_class in deployed.items():
+            if name not in desired:
+                self.logger.info(f"Deleting PriorityClass {name} as it is no longer configured")
+                client.delete(PriorityClass, name)
+            elif priority_class.value != desired[name].value:
+                self.logger.info(f"Deleting PriorityClass {name} to recreate it with a new value")
+                client.delete(PriorityClass, name)
+
+        for name in desired.keys() - deployed.keys():
+            try:
+                client.get(PriorityClass, name)
+            except ApiError as error:
+                if error.status.code == 404:
+                    continue
+                raise
+            raise ErrorWithStatus(
+                f"PriorityClass {name} already exists and is not managed by this charm,"
+                " set create-priority-class=false to use it",
+                BlockedStatus,
+            )
+
     def _gen_certs_if_missing(self):
         """Generate certificates if they don't already exist in _stored."""
         self.logger.info("_gen_certs_if_missing")
@@ -104,7 +188,9 @@ class NamespaceNodeAffinityOperator(CharmBase):
 
     def _gen_certs(self):
         """Refresh the certificates, overwriting them if they already existed."""
-        certs = gen_certs(model=self._namespace, service_name=f"{self._name}-pod-webhook")
+        with self._trace_phase("gen_certs") as span:
+            certs = gen_certs(model=self._namespace, service_name=f"{self._name}-pod-webhook")
+            span.set_attribute("certs.bytes", sum(len(v) for v in certs.values()))
         for k, v in certs.items():
             setattr(self._stored, k, v)
 
@@ -115,8 +201,10 @@ class NamespaceNodeAffinityOperator(CharmBase):
             self._k8s_resource_handler = KubernetesResourceHandler(
                 field_manager=self._lightkube_field_manager,
                 template_files=K8S_RESOURCE_FILES,
-                context=self._context,
                 logger=self.logger,
+                lightkube_client=ApiCallCountingClient(
+                    field_manager=self._lightkube_field_manager
+                ),
                 labels=create_charm_default_labels(
                     self.app.name,
                     self.model.name,
@@ -131,9 +219,12 @@ class NamespaceNodeAffinityOperator(CharmBase):
                     ServiceAccount,
                     Secret,
                     ConfigMap,
+                    PriorityClass,
                 },
             )
-        load_in_cluster_generic_resources(self._k8s_resource_handler.lightkube_client)
+        with self._trace_phase("discover_generic_resources") as span:
+            with self._record_api_calls(self._k8s_resource_handler, span):
+                load_in_cluster_generic_resources(self._k8s_resource_handler.lightkube_client)
         return self._k8s_resource_handler
 
     @k8s_resource_handler.setter
@@ -150,6 +241,13 @@ class NamespaceNodeAffinityOperator(CharmBase):
             "cert": b64encode(self._cert.encode("ascii")).decode("utf-8"),
             "cert_key": b64encode(self._cert_key.encode("ascii")).decode("utf-8"),
             "configmap_settings": self._get_settings_yaml(),
+            "image_pull_policy": self._get_image_pull_policy(),
+            "priority_class_name": self._get_priority_class_name(),
+            "create_priority_class": self.model.config["create-priority-class"],
+            "priority_class_value": self._get_priority_class_value(),
+            "node_selector": self._get_yaml_config("node-selector", dict),
+            "affinity": self._get_yaml_config("affinity", dict),
+            "tolerations": self._get_yaml_config("tolerations", list),
         }
 
     def _get_settings_yaml(self):
@@ -161,6 +259,61 @@ class NamespaceNodeAffinityOperator(CharmBase):
         settings = yaml.safe_load(self.model.config["settings_yaml"])
         return yaml.dump(settings)
 
+    def _get_image_pull_policy(self):
+        """Return the image-pull-policy config, raising if it is not a valid policy."""
+        policy = self.model.config["image-pull-policy"]
+        if policy not in IMAGE_PULL_POLICIES:
+            raise ErrorWithStatus(
+                f"Invalid image-pull-policy '{policy}', must be one of {IMAGE_PULL_POLICIES}",
+                BlockedStatus,
+            )
+        return policy
+
+    def _get_priority_class_name(self):
+        """Return the name of the PriorityClass for the webhook pods, or an empty string.
+
+        Raises ErrorWithStatus if the name is not a valid Kubernetes object name.
+        """
+        name = self.model.config["priority-class-name"]
+        if not name and self.model.config["create-priority-class"]:
+            name = f"{self._name}-pod-webhook"
+        if name and (len(name) > 253 or not DNS_1123_SUBDOMAIN.match(name)):
+            raise ErrorWithStatus(
+                f"Invalid priority-class-name '{name}', must be a DNS-1123 subdomain",
+                BlockedStatus,
+            )
+        return name
+
+    def _get_priority_class_value(self):
+        """Return the priority-class-value config, raising if Kubernetes would reject it."""
+        value = self.model.config["priority-class-value"]
+        if self.model.config["create-priority-class"] and value > MAX_PRIORITY_CLASS_VALUE:
+            raise ErrorWithStatus(
+                f"priority-class-value must be at most {MAX_PRIORITY_CLASS_VALUE}, got {value}",
+                BlockedStatus,
+            )
+        return value
+
+    def _get_yaml_config(self, key, expected_type):
+        """Return the parsed YAML of config `key`, or None if the config is empty.
+
+        Raises ErrorWithStatus if the config is not valid YAML of the expected type.
+        """
+        value = self.model.config[key]
+        if not value:
+            return None
+
+        try:
+            parsed = yaml.safe_load(value)
+        except yaml.YAMLError as error:
+            self.logger.error(f"Failed to parse {key} config: {error}")
+            raise ErrorWithStatus(f"Invalid YAML in {key} config", BlockedStatus)
+        if not isinstance(parsed, expected_type):
+            raise ErrorWithStatus(
+                f"{key} config must be a YAML {expected_type.__name__}", BlockedStatus
+            )
+        return parsed
+
     @property
     def _cert(self):
         return self._stored.cert
@@ -178,7 +331,11 @@ class NamespaceNodeAffinityOperator(CharmBase):
         self.logger.info("Removing k8s resources")
         try:
             self.unit.status = MaintenanceStatus("Removing k8s resources")
-            self.k8s_resource_handler.delete()
+            k8s_resource_handler = self.k8s_resource_handler
+            with self._trace_phase("delete") as span:
+                with self._record_api_calls(k8s_resource_handler, span) as api_calls:
+                    k8s_resource_handler.delete()
+                span.set_attribute("k8s.objects", api_calls["delete"])
         except ApiError:
             self.logger.error("K8s resource removal failed with ApiError:")
             self.logger.error(str(ApiError))
@@ -187,6 +344,73 @@ class NamespaceNodeAffinityOperator(CharmBase):
 
         self.model.unit.status = MaintenanceStatus("K8s resources removed")
 
+    @contextmanager
+    def _trace_phase(self, phase):
+        """Run a phase of the hook inside a tracing span, recording its duration.
+
+        Durations are accumulated per phase, so a phase that runs more than once in a hook is
+        reported as a single total by _log_phase_summary.
+        """
+        start = time.perf_counter()
+        with tracer.start_as_current_span(phase) as span:
+            try:
+                yield span
+            finally:
+                self._phase_durations[phase] = (
+                    self._phase_durations.get(phase, 0.0) + time.perf_counter() - start
+                )
+
+    @contextmanager
+    def _record_api_calls(self, k8s_resource_handler, span):
+        """Record on span the number of API calls made by the resource handler's client.
+
+        Yields a Counter that, once the context exits, holds the calls made per client method.
+        """
+        api_calls = Counter()
+        client_api_calls = getattr(k8s_resource_handler.lightkube_client, "api_calls", None)
+        # only an ApiCallCountingClient can be measured
+        if not isinstance(client_api_calls, Counter):
+            yield api_calls
+            return
+
+        before = client_api_calls.copy()
+        try:
+            yield api_calls
+        finally:
+            api_calls.update(client_api_calls - before)
+            span.set_attribute("k8s.api_calls", sum(api_calls.values()))
+
+    def _add_tracing_file_sink(self):
+        """Also write spans to the file at tracing-file-path, if set, eg: to inspect them in tests.
+
+        Spans are written as one JSON object per line, independently of the charm-tracing relation.
+        """
+        path = self.model.config["tracing-file-path"]
+        provider = trace.get_tracer_provider()
+        # The SDK tracer provider is only set up when the charm is dispatched with tracing enabled
+        if not path or not isinstance(provider, TracerProvider):
+            return
+
+        try:
+            out = open(path, "a")
+        except OSError as error:
+            self.logger.warning(f"Cannot write spans to tracing-file-path {path}: {error}")
+            return
+        exporter = ConsoleSpanExporter(
+            out=out, formatter=lambda span: span.to_json(indent=None) + os.linesep
+        )
+        provider.add_span_processor(SimpleSpanProcessor(exporter))
+
+    def _log_phase_summary(self, _):
+        """Log a single line summarising the time spent in each phase of this hook."""
+        if not self._phase_durations:
+            return
+        hook = os.path.basename(os.environ.get("JUJU_DISPATCH_PATH", "")) or "unknown"
+        phases = ", ".join(
+            f"{phase}={duration:.3f}s" for phase, duration in self._phase_durations.items()
+        )
+        self.logger.info(f"Hook {hook} phase summary: {phases}")
+
 
 if __name__ == "__main__":
     main(NamespaceNodeAffinityOperator)
@@ -7,5 +7,8 @@ output "provides" {
 }
 
 output "requires" {
-  value = {}
+  value = {
+    charm_tracing   = "charm-tracing",
+    receive_ca_cert = "receive-ca-cert",
+  }
 }
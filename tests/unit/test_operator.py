@@ -3,18 +3,32 @@
 #
 
 """Unit tests for Namespace Node Affinity/Charm."""
+import json
 from base64 import b64encode
+from unittest.mock import MagicMock, call
 
+import httpx
 import pytest
 import yaml
-from charmed_kubeflow_chisme.kubernetes import create_charm_default_labels
+from charmed_kubeflow_chisme.exceptions import ErrorWithStatus
+from charmed_kubeflow_chisme.kubernetes import (
+    KubernetesResourceHandler,
+    create_charm_default_labels,
+)
+from lightkube import ApiError, Client
+from lightkube.models.meta_v1 import ObjectMeta
 from lightkube.resources.admissionregistration_v1 import MutatingWebhookConfiguration
 from lightkube.resources.apps_v1 import Deployment
 from lightkube.resources.core_v1 import ConfigMap, Secret, Service, ServiceAccount
 from lightkube.resources.rbac_authorization_v1 import Role, RoleBinding
-from ops.model import WaitingStatus
+from lightkube.resources.scheduling_v1 import PriorityClass
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from ops.model import BlockedStatus, MaintenanceStatus, WaitingStatus
 from ops.testing import Harness
 
+from api_call_counter import ApiCallCountingClient
 from charm import K8S_RESOURCE_FILES, NamespaceNodeAffinityOperator
 
 # Used for test_get_settings_yaml
@@ -42,6 +56,26 @@ def harness() -> Harness:
     return harness
 
 
+@pytest.fixture(scope="function")
+def span_exporter(mocker) -> InMemorySpanExporter:
+    """Route the charm's spans to an in-memory exporter and return it."""
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    mocker.patch("charm.tracer", provider.get_tracer("charm"))
+    mocker.patch("certs.tracer", provider.get_tracer("certs"))
+    return exporter
+
+
+@pytest.fixture(scope="function")
+def counting_client(mocker) -> ApiCallCountingClient:
+    """Return an ApiCallCountingClient that does not connect to a cluster."""
+    for method in ["__init__", "get", "apply", "patch", "delete"]:
+        mocker.patch.object(Client, method, return_value=None)
+    mocker.patch.object(Client, "list", return_value=[])
+    return ApiCallCountingClient()
+
+
 class TestCharm:
     """Test class for NamespaceNodeAffinityOperator."""
 
@@ -75,6 +109,13 @@ class TestCharm:
             "cert": b64encode(cert.encode("ascii")).decode("utf-8"),
             "cert_key": b64encode(cert_key.encode("ascii")).decode("utf-8"),
             "configmap_settings": f"{settings_yaml}\n",
+            "image_pull_policy": "IfNotPresent",
+            "priority_class_name": "",
+            "create_priority_class": False,
+            "priority_class_value": 1000000,
+            "node_selector": None,
+            "affinity": None,
+            "tolerations": None,
         }
 
         assert harness.charm._context == expected_context
@@ -85,7 +126,6 @@ class TestCharm:
         harness.begin()
         logger = "logger"
         harness.charm.logger = logger
-        context = harness.charm._context
         field_manager = "field_manager"
         harness.charm._lightkube_field_manager = field_manager
         k8s_resource_files = K8S_RESOURCE_FILES
@@ -95,6 +135,7 @@ class TestCharm:
         # actually using a client
         krh_mocker = mocker.patch("charm.KubernetesResourceHandler")
         krh_mocker.return_value = MockedKRH()
+        counting_client_mocker = mocker.patch("charm.ApiCallCountingClient")
         mocked_load_in_cluster_generic_resources = mocker.patch(
             "charm.load_in_cluster_generic_resources"
         )
@@ -104,8 +145,8 @@ class TestCharm:
         krh_mocker.assert_called_once_with(
             field_manager=field_manager,
             template_files=k8s_resource_files,
-            context=context,
             logger=logger,
+            lightkube_client=counting_client_mocker.return_value,
             labels=create_charm_default_labels(
                 harness.model.app.name,
                 harness.model.name,
@@ -120,6 +161,7 @@ class TestCharm:
                 ServiceAccount,
                 Secret,
                 ConfigMap,
+                PriorityClass,
             },
         )
         mocked_load_in_cluster_generic_resources.assert_called_once_with("lightkube_client")
@@ -202,6 +244,283 @@ class TestCharm:
         returned_settings = harness.charm._get_settings_yaml()
         assert returned_settings == expected_settings
 
+    def test_deploy_k8s_resources_traces_phases(
+        self,
+        harness: Harness,
+        span_exporter: InMemorySpanExporter,
+        counting_client: ApiCallCountingClient,
+        mocker,
+    ):
+        """Test that _deploy_k8s_resources emits a separate span per phase with its attributes."""
+        # Arrange
+        mocked_load_in_cluster_generic_resources = mocker.patch(
+            "charm.load_in_cluster_generic_resources"
+        )
+        harness.begin()
+        resources = [
+            ConfigMap(metadata=ObjectMeta(name="a"), data={"key": "value"}),
+            ServiceAccount(metadata=ObjectMeta(name="b")),
+        ]
+        mocked_krh = MagicMock()
+        mocked_krh.lightkube_client = counting_client
+        mocked_krh.render_manifests.return_value = resources
+        mocked_krh.apply.side_effect = lambda: [counting_client.apply(r) for r in resources]
+        harness.charm.k8s_resource_handler = mocked_krh
+
+        # Act
+        harness.charm._deploy_k8s_resources()
+
+        # Assert
+        mocked_krh.apply.assert_called_once()
+        mocked_load_in_cluster_generic_resources.assert_called_once()
+        spans = {span.name: span for span in span_exporter.get_finished_spans()}
+        assert spans["gen_certs"].attributes["certs.bytes"] > 0
+        assert "openssl genrsa" in spans
+        # discovery runs before, not inside, the render phase
+        assert spans["discover_generic_resources"].end_time <= spans["render"].start_time
+        assert spans["discover_generic_resources"].attributes["k8s.api_calls"] == 0
+        assert spans["render"].attributes["k8s.objects"] == len(resources)
+        assert spans["render"].attributes["k8s.payload_bytes"] > 0
+        # listing the deployed PriorityClasses, then applying each object
+        assert spans["apply"].attributes["k8s.api_calls"] == 1 + len(resources)
+
+    def test_on_remove_traces_delete(
+        self,
+        harness: Harness,
+        span_exporter: InMemorySpanExporter,
+        counting_client: ApiCallCountingClient,
+        mocker,
+    ):
+        """Test that _on_remove records the objects deleted and the API calls made."""
+        # Arrange
+        mocker.patch("charm.load_in_cluster_generic_resources")
+        harness.begin()
+        mocked_krh = MagicMock()
+        mocked_krh.lightkube_client = counting_client
+
+        def delete():
+            counting_client.list(ConfigMap)
+            counting_client.delete(ConfigMap, "a")
+            counting_client.delete(ConfigMap, "b")
+
+        mocked_krh.delete.side_effect = delete
+        harness.charm.k8s_resource_handler = mocked_krh
+
+        # Act
+        harness.charm._on_remove(None)
+
+        # Assert
+        spans = {span.name: span for span in span_exporter.get_finished_spans()}
+        assert spans["delete"].attributes["k8s.objects"] == 2
+        assert spans["delete"].attributes["k8s.api_calls"] == 3
+
+    def test_tracing_file_sink(self, harness: Harness, tmp_path, mocker):
+        """Test that spans are also written to tracing-file-path as JSON lines."""
+        # Arrange
+        provider = TracerProvider()
+        mocker.patch("charm.trace.get_tracer_provider", return_value=provider)
+        mocker.patch("charm.tracer", provider.get_tracer("charm"))
+        spans_file = tmp_path / "spans.jsonl"
+        harness.update_config({"tracing-file-path": str(spans_file)})
+
+        # Act
+        harness.begin()
+        with harness.charm._trace_phase("render"):
+            pass
+
+        # Assert
+        spans = [json.loads(line) for line in spans_file.read_text().splitlines()]
+        assert [span["name"] for span in spans] == ["gen_certs", "render"]
+
+    def test_log_phase_summary(self, harness: Harness, caplog):
+        """Test that a single phase summary line is logged when the hook commits."""
+        harness.begin()
+        harness.charm._phase_durations = {"render": 0.25, "apply": 1.5}
+
+        harness.framework.commit()
+
+        assert "phase summary: render=0.250s, apply=1.500s" in caplog.text
+
+    def test_scheduling_config_rendered(self, harness: Harness):
+        """Test that the scheduling configs are rendered into the webhook resources."""
+        # Arrange
+        tolerations = [{"key": "dedicated", "operator": "Exists", "effect": "NoSchedule"}]
+        affinity = {
+            "nodeAffinity": {
+                "requiredDuringSchedulingIgnoredDuringExecution": {
+                    "nodeSelectorTerms": [
+                        {"matchExpressions": [{"key": "infra", "operator": "Exists"}]}
+                    ]
+                }
+            }
+        }
+        harness.update_config(
+            {
+                "image-pull-policy": "Always",
+                "create-priority-class": True,
+                "priority-class-value": 2000,
+                "node-selector": "kubernetes.io/os: linux",
+                "affinity": yaml.dump(affinity),
+                "tolerations": yaml.dump(tolerations),
+            }
+        )
+        harness.begin()
+
+        # Act
+        krh = KubernetesResourceHandler(
+            field_manager="test",
+            template_files=K8S_RESOURCE_FILES,
+            context=harness.charm._context,
+        )
+        resources = krh.render_manifests()
+
+        # Assert
+        priority_class_name = f"{harness.model.app.name}-pod-webhook"
+        priority_class = next(r for r in resources if isinstance(r, PriorityClass))
+        assert priority_class.metadata.name == priority_class_name
+        assert priority_class.value == 2000
+
+        pod_spec = next(r for r in resources if isinstance(r, Deployment)).spec.template.spec
+        assert pod_spec.containers[0].imagePullPolicy == "Always"
+        assert pod_spec.priorityClassName == priority_class_name
+        assert pod_spec.nodeSelector == {"kubernetes.io/os": "linux"}
+        assert pod_spec.affinity.to_dict() == affinity
+        assert [t.to_dict() for t in pod_spec.tolerations] == tolerations
+
+    def test_scheduling_config_defaults_not_rendered(self, harness: Harness):
+        """Test that no scheduling fields or PriorityClass are rendered by default."""
+        harness.begin()
+
+        krh = KubernetesResourceHandler(
+            field_manager="test",
+            template_files=K8S_RESOURCE_FILES,
+            context=harness.charm._context,
+        )
+        resources = krh.render_manifests()
+
+        assert not any(isinstance(r, PriorityClass) for r in resources)
+        pod_spec = next(r for r in resources if isinstance(r, Deployment)).spec.template.spec
+        assert pod_spec.containers[0].imagePullPolicy == "IfNotPresent"
+        assert pod_spec.priorityClassName is None
+        assert pod_spec.nodeSelector is None
+        assert pod_spec.affinity is None
+        assert pod_spec.tolerations is None
+
+    @pytest.mark.parametrize(
+        "config",
+        [
+            {"image-pull-policy": "Sometimes"},
+            {"node-selector": "- not-a-mapping"},
+            {"affinity": "nodeAffinity: ["},
+            {"tolerations": "key: value"},
+            {"priority-class-name": "yes:no"},
+            {"priority-class-name": "Not_A_Name"},
+            {"create-priority-class": True, "priority-class-value": 1000000001},
+        ],
+    )
+    def test_invalid_scheduling_config(self, config, harness: Harness):
+        """Test that invalid scheduling configs raise a BlockedStatus."""
+        harness.update_config(config)
+        harness.begin()
+
+        with pytest.raises(ErrorWithStatus) as error:
+            harness.charm._context
+
+        assert error.value.status_type == BlockedStatus
+
+    def test_deploy_k8s_resources_sets_context(self, harness: Harness, mocker):
+        """Test that the context is set on the resource handler before rendering."""
+        mocker.patch("charm.load_in_cluster_generic_resources")
+        harness.begin()
+        mocked_krh = MagicMock()
+        harness.charm.k8s_resource_handler = mocked_krh
+
+        harness.charm._deploy_k8s_resources()
+
+        assert mocked_krh.context == harness.charm._context
+        mocked_krh.render_manifests.assert_called_once()
+
+    def test_on_remove_with_invalid_config(self, harness: Harness, mocker):
+        """Test that the charm can be removed even if the config is invalid."""
+        mocker.patch("charm.load_in_cluster_generic_resources")
+        mocker.patch("charm.ApiCallCountingClient")
+        krh_mocker = mocker.patch("charm.KubernetesResourceHandler")
+        harness.update_config({"tolerations": "key: value"})
+        harness.begin()
+
+        harness.charm._on_remove(None)
+
+        krh_mocker.return_value.delete.assert_called_once()
+        assert harness.charm.model.unit.status == MaintenanceStatus("K8s resources removed")
+
+    def test_deploy_k8s_resources_recreates_changed_priority_class(self, harness: Harness, mocker):
+        """Test that a PriorityClass whose value changed is deleted before being re-applied."""
+        # Arrange
+        mocker.patch("charm.load_in_cluster_generic_resources")
+        harness.begin()
+        mocked_krh = MagicMock()
+        mocked_krh.render_manifests.return_value = [priority_class("pc", 2000)]
+        mocked_krh.lightkube_client.list.return_value = [priority_class("pc", 1000)]
+        harness.charm.k8s_resource_handler = mocked_krh
+
+        # Act
+        harness.charm._deploy_k8s_resources()
+
+        # Assert
+        calls = [
+            c for c in mocked_krh.method_calls if c[0] in ("lightkube_client.delete", "apply")
+        ]
+        assert calls == [call.lightkube_client.delete(PriorityClass, "pc"), call.apply()]
+
+    def test_reconcile_priority_classes_deletes_stale(self, harness: Harness):
+        """Test that charm-created PriorityClasses that are no longer rendered are deleted."""
+        harness.begin()
+        mocked_krh = MagicMock()
+        mocked_krh.lightkube_client.list.return_value = [
+            priority_class("old", 1000),
+            priority_class("pc", 1000),
+        ]
+
+        harness.charm._reconcile_priority_classes(mocked_krh, [priority_class("pc", 1000)])
+
+        mocked_krh.lightkube_client.list.assert_called_once_with(
+            PriorityClass, labels=mocked_krh.labels
+        )
+        mocked_krh.lightkube_client.delete.assert_called_once_with(PriorityClass, "old")
+        mocked_krh.lightkube_client.get.assert_not_called()
+
+    def test_reconcile_priority_classes_new(self, harness: Harness):
+        """Test that a PriorityClass that does not exist yet is left for apply to create."""
+        harness.begin()
+        mocked_krh = MagicMock()
+        mocked_krh.lightkube_client.list.return_value = []
+        mocked_krh.lightkube_client.get.side_effect = ApiError(
+            response=httpx.Response(404, json={"code": 404, "message": "not found"})
+        )
+
+        harness.charm._reconcile_priority_classes(mocked_krh, [priority_class("pc", 1000)])
+
+        mocked_krh.lightkube_client.get.assert_called_once_with(PriorityClass, "pc")
+        mocked_krh.lightkube_client.delete.assert_not_called()
+
+    def test_reconcile_priority_classes_not_managed(self, harness: Harness):
+        """Test that an existing PriorityClass not created by the charm is not taken over."""
+        harness.begin()
+        mocked_krh = MagicMock()
+        mocked_krh.lightkube_client.list.return_value = []
+        mocked_krh.lightkube_client.get.return_value = priority_class("pc", 1000)
+
+        with pytest.raises(ErrorWithStatus) as error:
+            harness.charm._reconcile_priority_classes(mocked_krh, [priority_class("pc", 1000)])
+
+        assert error.value.status_type == BlockedStatus
+        mocked_krh.lightkube_client.delete.assert_not_called()
+
+
+def priority_class(name: str, value: int) -> PriorityClass:
+    """Return a PriorityClass with the given name and value."""
+    return PriorityClass(metadata=ObjectMeta(name=name), value=value)
+
 
 class MockedKRH:
     """Mocked KubernetesResourceHandler."""